@@ -1,28 +1,49 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import Response
+from starlette.requests import HTTPConnection
+from pydantic import BaseModel, Field, ValidationError
 import chess
 import chess.pgn
-from stockfish import Stockfish
+from stockfish import Stockfish, StockfishException
+from cachetools import LRUCache
+import msgpack
+import psutil
+import redis.asyncio as aioredis
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
 import io
+import logging
+import re
+import threading
+import time
 import sys
 import os
 import shutil
+import subprocess
 import platform
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Tuple
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Chess Analysis API", version="1.0.0")
 
 # CORS za Next.js frontend - dodano više URL-ova
+# Starlette ne podržava wildcard u allow_origins, pa Vercel/Netlify deploymente
+# (i localhost na bilo kojem portu) hvata jedan kompajlirani regex
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
         "http://localhost:3000",
         "http://localhost:3001",
         "http://127.0.0.1:3000",
-        "https://*.vercel.app",
-        "https://*.netlify.app"
     ],
+    allow_origin_regex=r"^(https?://(localhost|127\.0\.0\.1)(:\d+)?|https://[^/]+\.(vercel|netlify)\.app)$",
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -67,30 +88,266 @@ def find_stockfish_path():
     # Provjeri svaki path
     for path in possible_paths:
         if os.path.isfile(path):
-            print(f"✅ Found Stockfish at: {path}")
+            logger.info("Found Stockfish at: %s", path)
             return path
     
     # Pokušaj pronaći u PATH-u
     stockfish_in_path = shutil.which("stockfish")
     if stockfish_in_path:
-        print(f"✅ Found Stockfish in PATH: {stockfish_in_path}")
+        logger.info("Found Stockfish in PATH: %s", stockfish_in_path)
         return stockfish_in_path
     
     # Ako ništa nije pronađeno
-    print("❌ Stockfish not found!")
-    print("📋 Tried these paths:")
-    for path in possible_paths:
-        print(f"   - {path}")
+    logger.warning("Stockfish not found! Tried these paths: %s", ", ".join(possible_paths))
     
     return None
 
 # Pokušaj pronaći Stockfish
 STOCKFISH_PATH = find_stockfish_path()
 
+# Engine pool - persistentni Stockfish procesi umjesto novog procesa po requestu
+# Svaki uvicorn worker (WEB_CONCURRENCY) ima svoj pool, pa dijele CPU i memoriju stroja
+WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+CPU_COUNT = max(1, (os.cpu_count() or 1) // WORKERS)
+POOL_SIZE = int(os.environ.get('STOCKFISH_POOL_SIZE', max(1, CPU_COUNT // min(4, CPU_COUNT))))
+THREADS_PER_ENGINE = int(os.environ.get('STOCKFISH_THREADS', max(1, CPU_COUNT // POOL_SIZE)))
+
+def default_hash_mb() -> int:
+    """
+    Hash (transposition tablica) po engineu - pola dostupne memorije podijeljeno
+    na sve engine u svim workerima, između 16 MB (default wrappera) i 1024 MB
+    """
+    available_mb = psutil.virtual_memory().available // (1024 * 1024)
+    return max(16, min(1024, available_mb // (2 * POOL_SIZE * WORKERS)))
+
+ENGINE_HASH_MB = int(os.environ.get('STOCKFISH_HASH_MB', 0)) or default_hash_mb()
+
+engine_pool: Optional["asyncio.Queue[Stockfish]"] = None
+_engines: List[Stockfish] = []
+
+# Stockfish stdio i PGN parsiranje su blokirajući - izvršavaju se u threadovima,
+# ne na event loopu. Dodatni workeri da PGN parsiranje ne čeka na zauzete engine.
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=POOL_SIZE + CPU_COUNT,
+    thread_name_prefix="stockfish",
+)
+
+def _new_engine() -> Stockfish:
+    # turn_perspective=False - evaluacije su uvijek iz perspektive bijelog
+    sf = Stockfish(path=STOCKFISH_PATH, turn_perspective=False)
+    # MultiPV 3 trajno, da get_top_moves(3) ne mijenja opciju pri svakom pozivu
+    sf.update_engine_parameters({
+        "Hash": ENGINE_HASH_MB,
+        "Threads": THREADS_PER_ENGINE,
+        "MultiPV": 3,
+        "UCI_LimitStrength": False,
+    })
+    return sf
+
+def _close_engine(sf: Stockfish):
+    """
+    Pošalji 'quit', pričekaj do 1s da proces završi i ubij ga ako ne završi -
+    inače ostaje zombie proces (i otvoreni pipeovi) dok GC ne pokupi wrapper.
+    'quit' se piše direktno u stdin jer send_quit_command() wrappera čeka
+    izlaz procesa u beskonačnoj petlji bez timeouta.
+    """
+    proc = sf._stockfish
+    if proc.poll() is None:
+        try:
+            proc.stdin.write("quit\n")
+            proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            pass
+        try:
+            proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+def _replace_engine(sf: Stockfish) -> Stockfish:
+    """Zatvori srušeni engine i vrati novi (ili stari, pa se pokušava opet idući put)"""
+    _close_engine(sf)
+    try:
+        new_sf = _new_engine()
+    except Exception:
+        logger.exception("Stockfish restart failed")
+        return sf
+    
+    _engines[_engines.index(sf)] = new_sf
+    return new_sf
+
+@app.on_event("startup")
+async def start_engine_pool():
+    """Pokreni POOL_SIZE Stockfish procesa jednom, pri startu servera"""
+    global engine_pool
+    engine_pool = asyncio.Queue()
+    if not STOCKFISH_PATH:
+        return
+
+    # Neispravan binary (kriva CPU verzija, dozvole...) ne smije srušiti cijeli
+    # API - /health to onda prijavi, a /api/analyze vraća 500
+    for _ in range(POOL_SIZE):
+        try:
+            sf = _new_engine()
+        except Exception:
+            logger.exception("Stockfish engine failed to start")
+            continue
+        _engines.append(sf)
+        engine_pool.put_nowait(sf)
+
+    logger.info(
+        "Started %d/%d Stockfish engine(s) with %d thread(s) and %d MB hash each",
+        len(_engines), POOL_SIZE, THREADS_PER_ENGINE, ENGINE_HASH_MB,
+    )
+
+@app.on_event("shutdown")
+async def stop_engine_pool():
+    """Zatvori sve Stockfish procese"""
+    # Gašenje blokira do 1s po engineu - izvan event loopa, paralelno
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(EXECUTOR, _close_engine, sf) for sf in _engines))
+    _engines.clear()
+    EXECUTOR.shutdown(wait=False)
+
+PGN_FEN_CACHE: "LRUCache[bytes, str]" = LRUCache(maxsize=10_000)
+_pgn_fen_cache_lock = threading.Lock()
+
+_MOVE_NUMBER_RE = re.compile(r"\d+\.+")
+_PGN_RESULTS = {"1-0", "0-1", "1/2-1/2", "*"}
+
+_UCI_MOVE_RE = re.compile(r"^[a-h][1-8][a-h][1-8][qrbn]?$")
+
+def _moves_to_fen(moves: List[str]) -> Optional[str]:
+    """
+    Odigraj listu poteza od početne pozicije i vrati FEN (None za ilegalan potez).
+    UCI potezi (e2e4) idu kroz push_uci i preskaču SAN parsiranje, ostali kroz push_san.
+    """
+    board = chess.Board()
+    try:
+        for move in moves:
+            if _UCI_MOVE_RE.match(move):
+                board.push_uci(move)
+            else:
+                board.push_san(move)
+    except ValueError:
+        return None
+    return board.fen()
+
+def _san_moves_to_fen(pgn: str) -> Optional[str]:
+    """
+    Brzi put za "PGN" koji je samo lista SAN poteza (bez headera, komentara i
+    varijacija) - preskače puni PGN parser. Vraća None ako to nije takav unos.
+    """
+    # Prazan unos ide kroz puni parser, koji ga odbija kao neispravan PGN
+    if not pgn.strip() or any(c in pgn for c in "[{(;$%"):
+        return None
+    
+    tokens = []
+    for token in _MOVE_NUMBER_RE.sub(" ", pgn).split():
+        if token in _PGN_RESULTS:
+            break
+        tokens.append(token)
+    return _moves_to_fen(tokens)
+
+def _pgn_to_fen(pgn: str) -> Optional[str]:
+    """
+    Odigraj PGN do kraja i vrati završni FEN (None za neispravan PGN).
+    Rezultat se pamti po hashu PGN-a pa je ponovno slanje istog PGN-a besplatno.
+    """
+    key = hashlib.blake2b(pgn.encode(), digest_size=16).digest()
+    with _pgn_fen_cache_lock:
+        fen = PGN_FEN_CACHE.get(key)
+    if fen is not None:
+        return fen
+    
+    fen = _san_moves_to_fen(pgn)
+    if fen is None:
+        game = chess.pgn.read_game(io.StringIO(pgn))
+        if not game:
+            return None
+        # end() + board() odigra mainline jednom, bez Python petlje po potezima
+        fen = game.end().board().fen()
+    
+    with _pgn_fen_cache_lock:
+        PGN_FEN_CACHE[key] = fen
+    return fen
+
+def _cp_conv(value: int) -> Tuple[float, Optional[int]]:
+    return value / 100.0, None
+
+def _mate_conv(value: int) -> Tuple[float, Optional[int]]:
+    return (10.0 if value > 0 else -10.0), value
+
+def _none_conv(value) -> Tuple[float, Optional[int]]:
+    return 0.0, None
+
+_CONV = {"cp": _cp_conv, "mate": _mate_conv}
+
+def convert_evaluation(evaluation: Optional[dict]) -> Tuple[float, Optional[int]]:
+    """Pretvori Stockfish evaluaciju ({'type', 'value'}) u (pawn score, mate_in)"""
+    if not evaluation:
+        return 0.0, None
+    return _CONV.get(evaluation['type'], _none_conv)(evaluation['value'])
+
+def parse_info_line(line: str) -> Optional[dict]:
+    """
+    Parsiraj UCI 'info depth N ... score cp|mate V ... pv M1 M2 ...' liniju.
+    Vraća None za linije bez točnog scorea (currmove, lowerbound/upperbound...).
+    """
+    tokens = line.split()
+    if not tokens or tokens[0] != "info" or "score" not in tokens or "pv" not in tokens:
+        return None
+    if "lowerbound" in tokens or "upperbound" in tokens:
+        return None
+    
+    try:
+        score_at = tokens.index("score")
+        pv_at = tokens.index("pv")
+        return {
+            "depth": int(tokens[tokens.index("depth") + 1]) if "depth" in tokens else 0,
+            "multipv": int(tokens[tokens.index("multipv") + 1]) if "multipv" in tokens else 1,
+            "type": tokens[score_at + 1],
+            "value": int(tokens[score_at + 2]),
+            "pv": tokens[pv_at + 1:],
+        }
+    except (ValueError, IndexError):
+        return None
+
+def _do_analysis(sf: Stockfish, fen: str, depth: int):
+    """
+    Blokirajući dio analize - poziva se iz EXECUTOR-a.
+    Jedan 'go depth N' s MultiPV 3 daje evaluaciju, najbolji potez i top 3 poteza,
+    umjesto tri odvojene pretrage iste pozicije.
+    """
+    sf.set_depth(depth)
+    # Bez 'ucinewgame' - hash tablica ostaje topla za srodne pozicije
+    sf.set_fen_position(fen)
+    
+    top_moves = sf.get_top_moves(3)
+    if not top_moves:
+        # Nema legalnih poteza - mat (gubi igrač na potezu) ili pat
+        board = chess.Board(fen)
+        if board.is_checkmate():
+            return (10.0 if board.turn == chess.BLACK else -10.0), 0, None, top_moves
+        return 0.0, None, None, top_moves
+    
+    best = top_moves[0]
+    if best["Mate"] is not None:
+        evaluation = {"type": "mate", "value": best["Mate"]}
+    else:
+        evaluation = {"type": "cp", "value": best["Centipawn"]}
+    eval_score, mate_in = convert_evaluation(evaluation)
+    return eval_score, mate_in, best["Move"], top_moves
+
+MAX_DEPTH = 22
+
 class AnalysisRequest(BaseModel):
     pgn: Optional[str] = None
     fen: Optional[str] = None
-    depth: int = 15
+    # Lista SAN ili UCI poteza od početne pozicije - brže od PGN-a
+    moves: Optional[List[str]] = None
+    # Ograničeno da klijent ne može zauzeti engine minutama (depth=50...)
+    depth: int = Field(15, ge=1, le=MAX_DEPTH)
 
 class AnalysisResponse(BaseModel):
     evaluation: float
@@ -98,6 +355,157 @@ class AnalysisResponse(BaseModel):
     principal_variation: List[str]
     mate_in: Optional[int] = None
 
+# Cache analiza - aplikacijska transposition tablica
+ANALYSIS_CACHE_SIZE = int(os.environ.get('ANALYSIS_CACHE_SIZE', 100_000))
+
+analysis_cache: "LRUCache[str, Tuple[int, AnalysisResponse]]" = LRUCache(maxsize=ANALYSIS_CACHE_SIZE)
+analysis_cache_lock = asyncio.Lock()
+
+def normalize_fen(fen: str) -> str:
+    """
+    Makni halfmove/fullmove brojače iz FEN-a kako bi transpozicije
+    iste pozicije dijelile cache entry
+    """
+    return " ".join(fen.split()[:4])
+
+# L2 cache u Redisu (ako je REDIS_URL postavljen) - dijele ga svi workeri i preživi restart
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_CACHE_TTL = int(os.environ.get('REDIS_CACHE_TTL', 7 * 24 * 3600))
+# Nakon greške Redis se preskače ovoliko sekundi, da nedostupan Redis ne
+# dodaje socket timeout na svaki zahtjev
+REDIS_RETRY_AFTER = float(os.environ.get('REDIS_RETRY_AFTER', 5))
+
+redis_client: Optional[aioredis.Redis] = None
+
+@app.on_event("startup")
+async def start_redis():
+    global redis_client
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+@app.on_event("shutdown")
+async def stop_redis():
+    if redis_client is not None:
+        # Dovrši upise koji su još u pozadini prije zatvaranja konekcije
+        await asyncio.gather(*_redis_writes, return_exceptions=True)
+        await redis_client.aclose()
+
+def redis_cache_key(fen_core: str, depth: int) -> str:
+    """
+    Kompaktan ključ - 16-bajtni hash pozicije umjesto cijelog FEN-a. Dubina je
+    dio ključa, pa workeri koji paralelno spremaju istu poziciju nikad ne
+    prepišu dublju analizu plićom.
+    """
+    return f"sf:v2:d{depth}:" + hashlib.blake2b(fen_core.encode(), digest_size=16).hexdigest()
+
+_redis_retry_at = 0.0
+_redis_writes: Set["asyncio.Task[None]"] = set()
+
+def _redis_usable() -> bool:
+    return redis_client is not None and time.monotonic() >= _redis_retry_at
+
+def _redis_failed(op: str, e: Exception):
+    global _redis_retry_at
+    _redis_retry_at = time.monotonic() + REDIS_RETRY_AFTER
+    logger.warning("Redis cache %s failed, skipping Redis for %.0fs: %s", op, REDIS_RETRY_AFTER, e)
+
+async def _redis_get(fen_core: str, depth: int) -> Optional[Tuple[int, AnalysisResponse]]:
+    """Najdublja analiza pozicije na dubini >= depth, jednim MGET-om"""
+    if not _redis_usable():
+        return None
+    depths = list(range(MAX_DEPTH, depth - 1, -1))
+    try:
+        values = await redis_client.mget([redis_cache_key(fen_core, d) for d in depths])
+    except (aioredis.RedisError, OSError) as e:
+        _redis_failed("read", e)
+        return None
+    
+    for cached_depth, raw in zip(depths, values):
+        if raw is None:
+            continue
+        # Oštećen ili stariji format entryja - tretira se kao promašaj, ne kao 500
+        try:
+            return cached_depth, AnalysisResponse.model_validate_json(raw)
+        except ValidationError as e:
+            logger.warning("Ignoring malformed Redis cache entry: %s", e)
+    return None
+
+async def _redis_set(fen_core: str, depth: int, response: AnalysisResponse):
+    if not _redis_usable():
+        return
+    try:
+        await redis_client.set(redis_cache_key(fen_core, depth), response.model_dump_json(), ex=REDIS_CACHE_TTL)
+    except (aioredis.RedisError, OSError) as e:
+        _redis_failed("write", e)
+
+async def _store_l1(fen_core: str, depth: int, response: AnalysisResponse):
+    """Spremi analizu, ali nikad ne prepiši dublju analizu plićom"""
+    async with analysis_cache_lock:
+        entry = analysis_cache.get(fen_core)
+        if entry is None or entry[0] <= depth:
+            analysis_cache[fen_core] = (depth, response)
+
+async def get_cached_analysis(fen_core: str, depth: int) -> Optional[AnalysisResponse]:
+    """
+    Vrati cached analizu samo ako je izračunata na barem traženoj dubini.
+    Prvo L1 (LRU u procesu), zatim L2 (Redis) - L2 pogodak se sprema i u L1.
+    """
+    async with analysis_cache_lock:
+        entry = analysis_cache.get(fen_core)
+    if entry is None or entry[0] < depth:
+        entry = await _redis_get(fen_core, depth)
+        if entry is None:
+            return None
+        await _store_l1(fen_core, *entry)
+    
+    return entry[1]
+
+async def store_cached_analysis(fen_core: str, depth: int, response: AnalysisResponse):
+    """Spremi analizu u L1 i L2 cache - upis u Redis ide u pozadini, odgovor ga ne čeka"""
+    await _store_l1(fen_core, depth, response)
+    if _redis_usable():
+        # Referenca u setu da task ne pokupi GC prije kraja
+        task = asyncio.create_task(_redis_set(fen_core, depth, response))
+        _redis_writes.add(task)
+        task.add_done_callback(_redis_writes.discard)
+
+# Rate limit po IP-u - token bucket gdje svaka razina dubine košta jedan token
+RATE_LIMIT_DEPTH_PER_MINUTE = int(os.environ.get('RATE_LIMIT_DEPTH_PER_MINUTE', 600))
+
+_rate_buckets: "LRUCache[str, List[float]]" = LRUCache(maxsize=10_000)
+
+ON_FLY = bool(os.environ.get('FLY_APP_NAME'))
+
+def get_client_ip(conn: HTTPConnection) -> str:
+    """
+    IP klijenta za rate limit. Fly-Client-IP se čita samo na fly.io (FLY_APP_NAME
+    postavlja platforma) - tamo ga fly-proxy uvijek prepiše, a drugdje ga klijent
+    može sam poslati i tako dobiti novi bucket za svaki zahtjev
+    """
+    if ON_FLY:
+        fly_ip = conn.headers.get("fly-client-ip")
+        if fly_ip:
+            return fly_ip
+    return conn.client.host if conn.client else "unknown"
+
+def take_depth_tokens(client_ip: str, depth: int) -> bool:
+    """Skini 'depth' tokena s bucketa klijenta; False ako ih nema dovoljno"""
+    if RATE_LIMIT_DEPTH_PER_MINUTE <= 0:
+        return True
+    
+    now = time.monotonic()
+    bucket = _rate_buckets.get(client_ip)
+    if bucket is None:
+        bucket = _rate_buckets[client_ip] = [float(RATE_LIMIT_DEPTH_PER_MINUTE), now]
+    
+    tokens, last = bucket
+    tokens = min(RATE_LIMIT_DEPTH_PER_MINUTE, tokens + (now - last) * RATE_LIMIT_DEPTH_PER_MINUTE / 60.0)
+    if tokens < depth:
+        bucket[0], bucket[1] = tokens, now
+        return False
+    bucket[0], bucket[1] = tokens - depth, now
+    return True
+
 @app.get("/")
 async def root():
     stockfish_status = "✅ Available" if STOCKFISH_PATH else "❌ Not found"
@@ -118,99 +526,405 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    try:
-        if not STOCKFISH_PATH:
-            return {
-                "status": "error",
-                "message": "Stockfish not found",
-                "stockfish_available": False
-            }
-        
-        # Test Stockfish connection
-        stockfish = Stockfish(path=STOCKFISH_PATH, depth=5)
-        stockfish.set_position(["e2e4"])  # Test move
-        test_eval = stockfish.get_evaluation()
-        
-        return {
-            "status": "healthy",
-            "message": "Stockfish is working correctly",
-            "stockfish_available": True,
-            "test_evaluation": test_eval
-        }
-    except Exception as e:
+    """Health check endpoint - vraća zadnji rezultat provjere, bez pokretanja enginea"""
+    if not STOCKFISH_PATH:
         return {
             "status": "error",
-            "message": f"Stockfish test failed: {str(e)}",
+            "message": "Stockfish not found",
             "stockfish_available": False
         }
+    
+    if ENGINE_HEALTHY:
+        return {
+            "status": "healthy",
+            "message": "Stockfish is working correctly",
+            "stockfish_available": True
+        }
+    
+    return {
+        "status": "error",
+        "message": f"Stockfish test failed: {ENGINE_HEALTH_ERROR}",
+        "stockfish_available": False
+    }
 
-@app.post("/api/analyze", response_model=AnalysisResponse)
-async def analyze_position(request: AnalysisRequest):
+# Pretrage u tijeku, po (fen_core, depth)
+INFLIGHT: Dict[Tuple[str, int], "asyncio.Task[AnalysisResponse]"] = {}
+
+async def _run_analysis(fen: str, fen_core: str, depth: int) -> AnalysisResponse:
+    """Analiziraj poziciju na engineu iz poola i spremi rezultat u cache"""
+    # Analyze with Stockfish - engine iz poola
+    loop = asyncio.get_running_loop()
+    stockfish = await engine_pool.get()
+    try:
+        eval_score, mate_in, best_move, top_moves = await loop.run_in_executor(
+            EXECUTOR, _do_analysis, stockfish, fen, depth
+        )
+    except (StockfishException, BrokenPipeError):
+        # Engine se srušio (npr. na neispravnom FEN-u) - ugasi ga i vrati novi u pool
+        logger.warning("Stockfish engine crashed, restarting it")
+        stockfish = await loop.run_in_executor(EXECUTOR, _replace_engine, stockfish)
+        raise
+    finally:
+        engine_pool.put_nowait(stockfish)
+    
+    # Get principal variation
+    pv = []
+    if top_moves:
+        pv = [move['Move'] for move in top_moves]
+    
+    response = AnalysisResponse(
+        evaluation=eval_score,
+        best_move=best_move or "",
+        principal_variation=pv,
+        mate_in=mate_in
+    )
+    await store_cached_analysis(fen_core, depth, response)
+    return response
+
+async def _analyze(request: AnalysisRequest, http_request: Request) -> AnalysisResponse:
+    """Zajednički dio /api/analyze i /api/analyze.msgpack"""
     try:
         # Provjeri je li Stockfish dostupan
-        if not STOCKFISH_PATH:
+        if not STOCKFISH_PATH or engine_pool is None or not _engines:
             raise HTTPException(
                 status_code=500, 
                 detail="Stockfish engine not found. Please install Stockfish first."
             )
         
-        # Initialize Stockfish
-        stockfish = Stockfish(path=STOCKFISH_PATH, depth=request.depth)
-        
         # Get position from PGN or FEN
         if request.pgn:
-            # Parse PGN to get final position
-            pgn_io = io.StringIO(request.pgn)
-            game = chess.pgn.read_game(pgn_io)
-            if not game:
+            # Parse PGN to get final position (izvan event loopa)
+            fen = await asyncio.get_running_loop().run_in_executor(
+                EXECUTOR, _pgn_to_fen, request.pgn
+            )
+            if not fen:
                 raise HTTPException(status_code=400, detail="Invalid PGN")
-            
-            board = game.board()
-            for move in game.mainline_moves():
-                board.push(move)
-            fen = board.fen()
+        elif request.moves is not None:
+            fen = await asyncio.get_running_loop().run_in_executor(
+                EXECUTOR, _moves_to_fen, request.moves
+            )
+            if not fen:
+                raise HTTPException(status_code=400, detail="Invalid moves")
         elif request.fen:
-            fen = request.fen
+            # Neispravan ili ilegalan FEN ne smije doći do dijeljenog enginea -
+            # ilegalne pozicije mogu srušiti ili zaglaviti Stockfish
+            try:
+                board = chess.Board(request.fen)
+            except ValueError:
+                board = None
+            if board is None or not board.is_valid():
+                raise HTTPException(status_code=400, detail="Invalid FEN")
+            fen = board.fen()
         else:
-            raise HTTPException(status_code=400, detail="Either PGN or FEN required")
-        
-        # Analyze with Stockfish
-        stockfish.set_fen_position(fen)
-        
-        evaluation = stockfish.get_evaluation()
-        best_move = stockfish.get_best_move()
-        top_moves = stockfish.get_top_moves(3)
+            raise HTTPException(status_code=400, detail="Either PGN, moves or FEN required")
         
-        # Convert evaluation
-        eval_score = 0.0
-        mate_in = None
+        # Provjeri cache prije pokretanja enginea
+        fen_core = normalize_fen(fen)
+        cached = await get_cached_analysis(fen_core, request.depth)
+        if cached is not None:
+            return cached
         
-        if evaluation and evaluation['type'] == 'cp':
-            eval_score = evaluation['value'] / 100.0
-        elif evaluation and evaluation['type'] == 'mate':
-            mate_in = evaluation['value']
-            eval_score = 10.0 if mate_in > 0 else -10.0
-        
-        # Get principal variation
-        pv = []
-        if top_moves:
-            pv = [move['Move'] for move in top_moves]
+        # Singleflight - istovremeni zahtjevi za istu poziciju čekaju istu pretragu
+        key = (fen_core, request.depth)
+        search = INFLIGHT.get(key)
+        if search is None:
+            # Samo pretrage koje stvarno pokreću engine troše tokene
+            if not take_depth_tokens(get_client_ip(http_request), request.depth):
+                raise HTTPException(status_code=429, detail="Rate limit exceeded, try a lower depth or wait")
+            
+            search = asyncio.create_task(_run_analysis(fen, fen_core, request.depth))
+            INFLIGHT[key] = search
+            search.add_done_callback(lambda _: INFLIGHT.pop(key, None))
         
-        return AnalysisResponse(
-            evaluation=eval_score,
-            best_move=best_move or "",
-            principal_variation=pv,
-            mate_in=mate_in
-        )
+        # shield - prekid jednog klijenta ne prekida pretragu koju čekaju ostali
+        return await asyncio.shield(search)
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Analysis error: {str(e)}")
+        logger.exception("analysis failed")
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
+@app.post("/api/analyze", response_model=AnalysisResponse)
+async def analyze_position(request: AnalysisRequest, http_request: Request):
+    # Gotovi JSON bajtovi iz pydantic-corea - preskače ponovnu validaciju
+    # response_modela i jsonable_encoder, što dominira kod cache pogodaka
+    response = await _analyze(request, http_request)
+    return Response(content=response.model_dump_json(), media_type="application/json")
+
+@app.post("/api/analyze.msgpack")
+async def analyze_position_msgpack(request: AnalysisRequest, http_request: Request):
+    """
+    Ista analiza kao /api/analyze, ali kompaktno za batch klijente: msgpack s
+    evaluacijom kao int16 centipawn vrijednošću umjesto floata u JSON-u
+    """
+    response = await _analyze(request, http_request)
+    centipawns = max(-32768, min(32767, int(round(response.evaluation * 100))))
+    return Response(
+        content=msgpack.packb({
+            "ev": centipawns,
+            "bm": response.best_move,
+            "pv": response.principal_variation,
+            "m": response.mate_in,
+        }),
+        media_type="application/x-msgpack",
+    )
+
+# WebSocket streaming - postepene 'info depth' evaluacije umjesto čekanja pune dubine
+async def _spawn_uci_process() -> asyncio.subprocess.Process:
+    """Pokreni Stockfish direktno, bez wrappera"""
+    return await asyncio.create_subprocess_exec(
+        STOCKFISH_PATH,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+
+UCI_READ_CHUNK = 64 * 1024
+
+async def _uci_line_batches(proc: asyncio.subprocess.Process):
+    """
+    Čitaj stdout u blokovima i vraćaj sve pristigle linije odjednom, umjesto
+    jednog awaita po liniji. Pozivatelj prestaje čitati na terminalnoj liniji
+    (uciok/readyok/bestmove), nakon koje engine ne ispisuje ništa do iduće naredbe.
+    """
+    pending = b""
+    while True:
+        chunk = await proc.stdout.read(UCI_READ_CHUNK)
+        if not chunk:
+            return
+        *lines, pending = (pending + chunk).split(b"\n")
+        if lines:
+            yield [line.strip() for line in lines]
+
+async def _uci_wait_for(proc: asyncio.subprocess.Process, token: bytes):
+    """Čitaj stdout dok engine ne odgovori s 'token'"""
+    async for batch in _uci_line_batches(proc):
+        if token in batch:
+            return
+    raise RuntimeError(f"Engine exited before sending {token.decode()}")
+
+async def _uci_handshake(proc: asyncio.subprocess.Process):
+    proc.stdin.write(b"uci\n")
+    await proc.stdin.drain()
+    await _uci_wait_for(proc, b"uciok")
+    
+    proc.stdin.write(f"setoption name Threads value {THREADS_PER_ENGINE}\nisready\n".encode())
+    await proc.stdin.drain()
+    await _uci_wait_for(proc, b"readyok")
+
+async def _start_uci_process() -> asyncio.subprocess.Process:
+    """Pokreni Stockfish i odradi UCI handshake"""
+    proc = await _spawn_uci_process()
+    try:
+        await _uci_handshake(proc)
+    except BaseException:
+        await _close_uci_process(proc)
+        raise
+    return proc
+
+async def _close_uci_process(proc: asyncio.subprocess.Process):
+    """Zaustavi trenutnu pretragu i ugasi proces"""
+    if proc.returncode is not None:
+        return
+    try:
+        try:
+            proc.stdin.write(b"stop\nquit\n")
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        await asyncio.wait_for(proc.wait(), timeout=1)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+    except asyncio.CancelledError:
+        # Task je otkazan (npr. pri zatvaranju veze) - ne čekamo, proces se ubija
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+        raise
+
+async def _stream_search(websocket: WebSocket, proc: asyncio.subprocess.Process, board: chess.Board, depth: int):
+    """
+    Pošalji 'go depth' i prosljeđuj info linije klijentu do 'bestmove'.
+    Iz svakog pročitanog bloka šalje se samo najdublja linija - pliće iz istog
+    bloka su već zastarjele.
+    """
+    # UCI score je iz perspektive igrača na potezu - kao i /api/analyze (pool engine
+    # s turn_perspective=False) vraćamo ga iz perspektive bijelog
+    sign = 1 if board.turn == chess.WHITE else -1
+    
+    proc.stdin.write(f"position fen {board.fen()}\ngo depth {depth}\n".encode())
+    await proc.stdin.drain()
+    
+    async for batch in _uci_line_batches(proc):
+        latest = None
+        best_move = None
+        for raw in batch:
+            line = raw.decode()
+            if line.startswith("bestmove"):
+                parts = line.split()
+                best_move = parts[1] if len(parts) > 1 and parts[1] != "(none)" else ""
+                break
+            info = parse_info_line(line)
+            if info is not None and info["multipv"] == 1:
+                latest = info
+        
+        if latest is not None:
+            # Pretvorba iz perspektive igrača na potezu (mate 0 = igrač na potezu je matiran),
+            # pa okretanje predznaka za perspektivu bijelog
+            eval_score, mate_in = convert_evaluation({"type": latest["type"], "value": latest["value"]})
+            eval_score *= sign
+            if mate_in is not None:
+                mate_in *= sign
+            await websocket.send_json({
+                "type": "info",
+                "depth": latest["depth"],
+                "evaluation": eval_score,
+                "mate_in": mate_in,
+                "principal_variation": latest["pv"],
+            })
+        if best_move is not None:
+            await websocket.send_json({"type": "bestmove", "best_move": best_move})
+            return
+    
+    raise RuntimeError("Engine exited before sending bestmove")
+
+# Health check - engine se provjerava pri startu i zatim periodički, izvan requesta
+ENGINE_CHECK_INTERVAL = int(os.environ.get('ENGINE_CHECK_INTERVAL', 60))
+
+ENGINE_HEALTHY = False
+ENGINE_HEALTH_ERROR: Optional[str] = "not checked yet"
+_engine_check_task: Optional[asyncio.Task] = None
+
+async def _check_engine():
+    """Pokreni Stockfish, pričekaj 'uciok'/'readyok' i zapamti rezultat"""
+    global ENGINE_HEALTHY, ENGINE_HEALTH_ERROR
+    try:
+        proc = await _spawn_uci_process()
+        try:
+            await asyncio.wait_for(_uci_handshake(proc), timeout=5)
+        finally:
+            await _close_uci_process(proc)
+        ENGINE_HEALTHY, ENGINE_HEALTH_ERROR = True, None
+    except Exception as e:
+        ENGINE_HEALTHY, ENGINE_HEALTH_ERROR = False, str(e) or type(e).__name__
+        logger.warning("Stockfish health check failed: %s", ENGINE_HEALTH_ERROR)
+
+async def _periodic_engine_check():
+    while True:
+        await asyncio.sleep(ENGINE_CHECK_INTERVAL)
+        await _check_engine()
+
+@app.on_event("startup")
+async def start_engine_check():
+    global _engine_check_task
+    if not STOCKFISH_PATH:
+        return
+    await _check_engine()
+    _engine_check_task = asyncio.create_task(_periodic_engine_check())
+
+@app.on_event("shutdown")
+async def stop_engine_check():
+    if _engine_check_task:
+        _engine_check_task.cancel()
+
+# Svaka WebSocket veza s aktivnom analizom drži vlastiti Stockfish proces -
+# broj takvih procesa ograničen je kao i REST pool
+WS_MAX_ENGINES = int(os.environ.get('WS_MAX_ENGINES', POOL_SIZE))
+ws_engine_slots = asyncio.Semaphore(WS_MAX_ENGINES)
+
+@app.websocket("/ws/analyze")
+async def analyze_stream(websocket: WebSocket):
+    """
+    Klijent šalje {"fen" | "pgn", "depth"}, server vraća {"type": "info", ...}
+    frameove kako engine napreduje po dubini i na kraju {"type": "bestmove", ...}.
+    Engine se pokreće tek na prvom ispravnom zahtjevu, a zatvaranje WebSocketa
+    šalje 'stop' engineu.
+    """
+    await websocket.accept()
+    if not STOCKFISH_PATH:
+        await websocket.send_json({"type": "error", "detail": "Stockfish engine not found"})
+        await websocket.close()
+        return
+    
+    proc = None
+    try:
+        while True:
+            try:
+                request = AnalysisRequest(**await websocket.receive_json())
+            except (ValidationError, TypeError, ValueError):
+                await websocket.send_json({"type": "error", "detail": "Invalid analysis request"})
+                continue
+            
+            if request.pgn:
+                fen = await asyncio.get_running_loop().run_in_executor(
+                    EXECUTOR, _pgn_to_fen, request.pgn
+                )
+            elif request.moves is not None:
+                fen = await asyncio.get_running_loop().run_in_executor(
+                    EXECUTOR, _moves_to_fen, request.moves
+                )
+            else:
+                fen = request.fen
+            
+            # Samo legalne pozicije idu engineu - npr. pozicija bez kralja ga može srušiti
+            try:
+                if not fen:
+                    raise ValueError("Either PGN, moves or FEN required")
+                board = chess.Board(fen)
+                if not board.is_valid():
+                    raise ValueError("Illegal position")
+            except ValueError:
+                await websocket.send_json({"type": "error", "detail": "Invalid PGN, moves or FEN"})
+                continue
+            
+            if proc is None and ws_engine_slots.locked():
+                await websocket.send_json({"type": "error", "detail": "Too many concurrent analyses, try again later"})
+                continue
+            
+            if not take_depth_tokens(get_client_ip(websocket), request.depth):
+                await websocket.send_json({"type": "error", "detail": "Rate limit exceeded"})
+                continue
+            
+            if proc is None:
+                # Slot je slobodan (provjereno gore, bez awaita između) pa acquire ne čeka
+                await ws_engine_slots.acquire()
+                try:
+                    proc = await _start_uci_process()
+                except Exception:
+                    ws_engine_slots.release()
+                    logger.exception("failed to start Stockfish for WebSocket analysis")
+                    await websocket.send_json({"type": "error", "detail": "Stockfish engine failed to start"})
+                    continue
+            
+            try:
+                await _stream_search(websocket, proc, board, request.depth)
+            except (RuntimeError, BrokenPipeError, ConnectionResetError):
+                # Engine se srušio - iduća analiza pokreće novi proces
+                logger.warning("Stockfish engine for WebSocket analysis exited, restarting on next request")
+                await websocket.send_json({"type": "error", "detail": "Analysis failed"})
+                try:
+                    await _close_uci_process(proc)
+                finally:
+                    proc = None
+                    ws_engine_slots.release()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if proc is not None:
+            try:
+                await _close_uci_process(proc)
+            finally:
+                ws_engine_slots.release()
+
 if __name__ == "__main__":
     import uvicorn
     
+    # Workeri nasljeđuju WEB_CONCURRENCY pa svaki računa svoj dio CPU-a i memorije
+    workers = int(os.environ.setdefault('WEB_CONCURRENCY', str(min(4, os.cpu_count() or 1))))
+    
     print("🚀 Starting Chess Analysis API...")
     print(f"📍 API will be available at: http://localhost:8000")
     print(f"📖 Docs available at: http://localhost:8000/docs")
@@ -224,4 +938,13 @@ if __name__ == "__main__":
         print("   Ubuntu: sudo apt-get install stockfish")
         print("   Windows: Download from https://stockfishchess.org/download/")
     
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Cache i engine pool su po workeru
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        # uvloop ne postoji na Windowsima
+        loop="asyncio" if platform.system() == "Windows" else "uvloop",
+        http="httptools",
+    )
\ No newline at end of file